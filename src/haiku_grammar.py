@@ -1,6 +1,6 @@
 from src.constants import *
 from src.Syllables import syllables_in_word
-from random import randint, choice
+from random import randint, choice, choices, random
 from pickle import load, dump
 
 
@@ -13,13 +13,87 @@ class UnsuccessfulPhraseGeneration(Exception):
 
 
 class GrammarModel:
-    def __init__(self, vocabulary: dict=None):
+    def __init__(self, vocabulary: dict=None, reservoir_size=8, reservoir_reuse_chance=0.5, adaptive=False,
+                 structure_stats: dict=None, structure_exploration=0.1):
         self.vocabulary = vocabulary
         if vocabulary is None:
             self.vocabulary = {}
         self.global_tags = (PAST, PRESENT, PERFECT, PROGRESSIVE, CONDITIONAL, SUBJUNCTIVE, PASSIVE, ACTIVE,
                             FIRST_PERSON, SECOND_PERSON, THIRD_PERSON, SINGULAR, PLURAL)
         self.current_global_tags = []
+        # Small reservoirs of previously generated sub-phrases, keyed by (phrase type, grammatical function, syllable
+        # count, agreement tags). Only nested sub-phrases are reused. A reservoir_size of 0 disables reuse entirely.
+        self.reservoir_size = reservoir_size
+        self.reservoir_reuse_chance = reservoir_reuse_chance
+        self.phrase_reservoirs = {}
+        # Success counts for each (phrase type, grammatical function, structure, min syllables, max syllables), stored
+        # as [successes, attempts]. When adaptive, structures are weighted by their smoothed success rate plus
+        # structure_exploration, so structures that rarely succeed are still tried now and then.
+        self.adaptive = adaptive
+        self.structure_stats = structure_stats
+        if structure_stats is None:
+            self.structure_stats = {}
+        self.structure_exploration = structure_exploration
+
+    def _reservoir_key(self, phrase_type, gram_function, syllables):
+        return phrase_type, gram_function, syllables, tuple(sorted(self.current_global_tags))
+
+    def draw_from_reservoir(self, phrase_type, gram_function, min_syllables, max_syllables):
+        if self.reservoir_size <= 0 or random() >= self.reservoir_reuse_chance:
+            return None
+
+        options = []
+        for syl_count in range(min_syllables, max_syllables + 1):
+            for phrase in self.phrase_reservoirs.get(self._reservoir_key(phrase_type, gram_function, syl_count), []):
+                options.append((syl_count, phrase))
+        if options:
+            return choice(options)
+        return None
+
+    def add_to_reservoir(self, phrase_type, gram_function, syllables, phrase):
+        if self.reservoir_size <= 0:
+            return
+
+        reservoir = self.phrase_reservoirs.setdefault(self._reservoir_key(phrase_type, gram_function, syllables), [])
+        if phrase in reservoir:
+            return
+        # Once a reservoir is full, a fresh phrase replaces a random entry so the output stays varied.
+        if len(reservoir) < self.reservoir_size:
+            reservoir.append(phrase)
+        else:
+            reservoir[randint(0, len(reservoir) - 1)] = phrase
+
+    def clear_reservoirs(self):
+        self.phrase_reservoirs = {}
+
+    def choose_structure(self, phrase_type, gram_function, min_syllables, max_syllables, structures):
+        if not self.adaptive:
+            return choice(structures)
+
+        weights = []
+        for structure in structures:
+            successes, attempts = self.structure_stats.get(
+                (phrase_type, gram_function, structure, min_syllables, max_syllables), (0, 0))
+            weights.append((successes + 1) / (attempts + 2) + self.structure_exploration)
+        return choices(structures, weights)[0]
+
+    def record_structure_outcome(self, phrase_type, gram_function, structure, min_syllables, max_syllables, success):
+        if not self.adaptive:
+            return
+
+        stats = self.structure_stats.setdefault((phrase_type, gram_function, structure, min_syllables, max_syllables),
+                                                [0, 0])
+        if success:
+            stats[0] += 1
+        stats[1] += 1
+
+    def save_structure_stats(self, file_path):
+        with open(file_path, 'wb') as f:
+            dump(self.structure_stats, f)
+
+    def load_structure_stats(self, file_path):
+        with open(file_path, 'rb') as f:
+            self.structure_stats = load(f)
 
     def add_word(self, word: str, syllables: int, tags: list):
         for key in self.vocabulary[syllables].keys():
@@ -70,7 +144,8 @@ class GrammarModel:
                 if key not in [GERUND, PARTICIPLE]:
                     structure_options.extend(all_structure_options[key])
 
-        chosen_structure = choice([opt[1:] for opt in structure_options if opt[0] <= max_syllables])
+        chosen_structure = self.choose_structure(VERB, gram_function, min_syllables, max_syllables,
+                                                 [opt[1:] for opt in structure_options if opt[0] <= max_syllables])
 
         tries = 0
 
@@ -96,18 +171,21 @@ class GrammarModel:
                         syllables, word = self.pick_word(current_min_syllables, current_max_syllables, [gram_function, VERB] if gram_function else [VERB])
                     elif word_form_to_pick is PREP_PHRASE:
                         current_max_syllables = max(current_max_syllables, 3)
-                        syllables, word = self.create_prep_phrase(3, current_max_syllables)
+                        syllables, word = self.create_prep_phrase(3, current_max_syllables, reuse=True)
                     elif word_form_to_pick is SUBJECT_COMPLIMENT:
                         syllables, word = self.create_subject_compliment(current_min_syllables, current_max_syllables)
                     elif word_form_to_pick is ADVERB:
                         syllables, word = self.pick_word(current_min_syllables, current_max_syllables, [ADVERB, gram_function])
                     elif word_form_to_pick is DIRECT_OBJECT:
                         current_max_syllables = max(current_max_syllables, 2)
-                        syllables, word = self.create_direct_object(current_min_syllables, current_max_syllables)
+                        syllables, word = self.create_direct_object(current_min_syllables, current_max_syllables, reuse=True)
                     else:
                         raise UnsuccessfulPhraseGeneration(f"Unknown word form for verbs: {word_form_to_pick}")
                 except ExhaustedVocabulary:
                     break
+                except UnsuccessfulPhraseGeneration:
+                    self.record_structure_outcome(VERB, gram_function, chosen_structure, min_syllables, max_syllables, False)
+                    raise
                 if word not in words_used:
                     options_used.append(word_form_to_pick)
                     words_used.append(word)
@@ -127,8 +205,10 @@ class GrammarModel:
                         options_used.pop(i)
                         break
 
+            self.record_structure_outcome(VERB, gram_function, chosen_structure, min_syllables, max_syllables, True)
             return syllables_used, ' '.join(verb_phrase)
 
+        self.record_structure_outcome(VERB, gram_function, chosen_structure, min_syllables, max_syllables, False)
         raise UnsuccessfulPhraseGeneration(f"Unsuccessfully met word count for verb phrase.")
 
     def create_subject_compliment(self, min_syllables, max_syllables, gram_form=None):
@@ -142,10 +222,11 @@ class GrammarModel:
         else:
             raise UnsuccessfulPhraseGeneration(f"Unknown grammatical form for subject compliment: {gram_form}")
 
-    def create_direct_object(self, min_syllables, max_syllables):
-        return self.create_noun_phrase(min_syllables, max_syllables, DIRECT_OBJECT)
+    def create_direct_object(self, min_syllables, max_syllables, reuse=False):
+        return self.create_noun_phrase(min_syllables, max_syllables, DIRECT_OBJECT, reuse=reuse)
 
-    def create_noun_phrase(self, min_syllables, max_syllables, gram_function=None, max_tries=20, chosen_structure=None):
+    def create_noun_phrase(self, min_syllables, max_syllables, gram_function=None, max_tries=20, chosen_structure=None,
+                           reuse=False):
         # Store what the global tags were before generation.
         starting_global_tags = self.current_global_tags.copy()
         # All possible structure options for noun phrases and their minimum syllable count.
@@ -166,14 +247,25 @@ class GrammarModel:
         if gram_function is None:
             gram_function = NOUN
 
+        # Only sub-phrases generated by another phrase are reused. Subject noun phrases set the global agreement tags
+        # while being generated, so they are never reused.
+        use_reservoir = reuse and chosen_structure is None and gram_function is not SUBJECT
+        if use_reservoir:
+            reused = self.draw_from_reservoir(NOUN, gram_function, min_syllables, max_syllables)
+            if reused is not None:
+                return reused
+
         # If the function of this noun phrase is the object of a preposition, we need a determiner in our structure.
         if gram_function in [DIRECT_OBJECT, OBJECT_OF_PREPOSITION]:
             structure_options = (opt for opt in structure_options if DETERMINER in opt)
 
         # Choose a structure out of all the options, as long as the minimum required syllable count for that structure
-        # is less than or equal to the noun phrase's maximum syllable count.
+        # is less than or equal to the noun phrase's maximum syllable count. Only structures we chose ourselves count
+        # toward the learned structure statistics.
+        record_outcome = chosen_structure is None
         if chosen_structure is None:
-            chosen_structure = choice([opt[1:] for opt in structure_options if opt[0] <= max_syllables])
+            chosen_structure = self.choose_structure(NOUN, gram_function, min_syllables, max_syllables,
+                                                     [opt[1:] for opt in structure_options if opt[0] <= max_syllables])
 
         tries = 0
 
@@ -211,17 +303,21 @@ class GrammarModel:
                         syllables, word = self.pick_word(current_min_syllables, current_max_syllables, [DETERMINER, gram_function])
                     elif word_form_to_pick is PREP_PHRASE:
                         current_max_syllables = max(current_max_syllables, 3)
-                        syllables, word = self.create_prep_phrase(current_min_syllables, current_max_syllables)
+                        syllables, word = self.create_prep_phrase(current_min_syllables, current_max_syllables, reuse=True)
                     elif word_form_to_pick is gram_function:
                         syllables, word = self.create_noun_phrase(current_min_syllables, current_max_syllables, gram_function)
                     elif word_form_to_pick is COORDINATING_CONJUNCTION:
                         syllables, word = self.pick_word(current_min_syllables, current_max_syllables, [COORDINATING_CONJUNCTION, gram_function])
                     elif word_form_to_pick is DIRECT_OBJECT:
-                        syllables, word = self.create_direct_object(current_min_syllables, current_max_syllables)
+                        syllables, word = self.create_direct_object(current_min_syllables, current_max_syllables, reuse=True)
                     else:
                         raise UnsuccessfulPhraseGeneration(f"Unknown word form for verbs: {word_form_to_pick}")
                 except ExhaustedVocabulary:
                     break
+                except UnsuccessfulPhraseGeneration:
+                    if record_outcome:
+                        self.record_structure_outcome(NOUN, gram_function, chosen_structure, min_syllables, max_syllables, False)
+                    raise
                 # If that word isn't already used in this phrase,
                 if word not in words_used:
                     # Update all the values appropriately.
@@ -247,25 +343,40 @@ class GrammarModel:
                         noun_phrase.append(words_used.pop(i))
                         options_used.pop(i)
                         break
-            # Then return the noun phrase, joined by spaces.
-            return syllables_used, ' '.join(noun_phrase)
-
+            # Then join the noun phrase by spaces and return it.
+            noun_phrase = ' '.join(noun_phrase)
+            if use_reservoir:
+                self.add_to_reservoir(NOUN, gram_function, syllables_used, noun_phrase)
+            if record_outcome:
+                self.record_structure_outcome(NOUN, gram_function, chosen_structure, min_syllables, max_syllables, True)
+            return syllables_used, noun_phrase
+
+        if record_outcome:
+            self.record_structure_outcome(NOUN, gram_function, chosen_structure, min_syllables, max_syllables, False)
         raise UnsuccessfulPhraseGeneration(f"Unsuccessfully met word count for verb phrase.")
 
-    def create_prep_phrase(self, min_syllables, max_syllables, max_tries=20):
+    def create_prep_phrase(self, min_syllables, max_syllables, max_tries=20, reuse=False):
+        if reuse:
+            reused = self.draw_from_reservoir(PREP_PHRASE, None, min_syllables, max_syllables)
+            if reused is not None:
+                return reused
+
         tries = 0
         while tries < max_tries:
             syllables_used = 0
             syllables, preposition = self.pick_word(1, max_syllables - 2, [PREPOSITION])
             syllables_used += syllables
-            syllables, object_of_preposition = self.create_noun_phrase(1, max_syllables - syllables_used, OBJECT_OF_PREPOSITION)
+            syllables, object_of_preposition = self.create_noun_phrase(1, max_syllables - syllables_used, OBJECT_OF_PREPOSITION, reuse=True)
             syllables_used += syllables
 
             if min_syllables > syllables_used or max_syllables < syllables_used:
                 tries += 1
                 continue
 
-            return syllables_used, ' '.join([preposition, object_of_preposition])
+            prep_phrase = ' '.join([preposition, object_of_preposition])
+            if reuse:
+                self.add_to_reservoir(PREP_PHRASE, None, syllables_used, prep_phrase)
+            return syllables_used, prep_phrase
 
         raise UnsuccessfulPhraseGeneration(f"Unsuccessfully met word count for prep phrase.")
 